@@ -175,7 +175,7 @@ class Ontologizer(object):
 
         return forward, reverse, list(for_header)
 
-    def reformat_table(self, thresh=None):
+    def reformat_table(self, thresh=None, lookup=None):
         """
         Reformats table to include name and description (rather than just GO
         ID), and annotates each term with genes.  Result is in self.outdir, and
@@ -184,6 +184,9 @@ class Ontologizer(object):
         If self.calcuation == 'MGSA' and `thresh` is not None, then only return
         terms with marginal posteriors > thresh.  If `thresh` is not None and
         self.calculation is something else, then only return lines < thresh.
+
+        `lookup` is an already-loaded GO lookup dictionary; if None, it is
+        loaded from files.FILES['lookup'].
         """
         if self.calculation == 'MGSA':
             p_col_label = 'marg'
@@ -192,7 +195,8 @@ class Ontologizer(object):
 
         # load json
         logger.info('Creating annotation lookups...')
-        lookup = simplejson.load(open(files.FILES['lookup']))
+        if lookup is None:
+            lookup = simplejson.load(open(files.FILES['lookup']))
         forward, reverse, for_header = self._annotations_lookup()
         fout = open(self._tablefile + '.reformatted', 'w')
         f = open(self._tablefile)
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+"""
+Run a local enrichment service; see ontologization.service.
+"""
+from ontologization import files
+from ontologization.service import EnrichmentService, make_server
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--organism', action='append',
+                    help='Organism to serve; can be specified multiple times. '
+                    'The first one is the default.  One of %s'
+                    % files.GENOME_ASSOCIATIONS.keys())
+    ap.add_argument('--host', default='127.0.0.1',
+                    help='Host to listen on (default %(default)s)')
+    ap.add_argument('--port', type=int, default=8765,
+                    help='Port to listen on (default %(default)s)')
+    ap.add_argument('--socket',
+                    help='Listen on this Unix socket instead of --host/--port')
+    ap.add_argument('--calculation', default='Parent-Child-Union',
+                    help='Ontologizer calculation (default %(default)s)')
+    ap.add_argument('--mtc', default='Westfall-Young-Single-Step',
+                    help='Multiple-testing correction (default %(default)s)')
+    ap.add_argument('--window', type=float, default=0.05,
+                    help='Seconds to wait for requests sharing a population '
+                    'before running a batch (default %(default)s)')
+    ap.add_argument('--max-batch', type=int, default=32,
+                    help='Maximum requests per batch (default %(default)s)')
+    ap.add_argument('--workdir',
+                    help='Directory for batch output (default: temp dir)')
+    ap.add_argument('--keep', action='store_true',
+                    help='Do not delete batch output directories')
+    args = ap.parse_args()
+
+    service = EnrichmentService(
+        organisms=args.organism,
+        calculation=args.calculation,
+        mtc=args.mtc,
+        window=args.window,
+        max_batch=args.max_batch,
+        workdir=args.workdir,
+        keep=args.keep)
+    server = make_server(service, host=args.host, port=args.port,
+                         socket_path=args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,469 @@
+"""
+Local enrichment service.
+
+Keeps the GO lookup loaded and the per-organism configuration checked and
+ready, and accepts gene lists as JSON over HTTP (TCP on localhost, or a Unix
+socket).  Requests that arrive within a short window and share a population
+(and organism) are coalesced into a single Ontologizer run: each gene list
+becomes one study set in a directory passed to Ontologizer.jar.  The jar
+still re-parses the ontology and annotations on every run, so this happens
+once per batch rather than once per request.
+
+POST /enrich with a JSON body like::
+
+    {"genes": ["FBgn0000001", ...],
+     "population": ["FBgn0000001", ...],
+     "organism": "dmelanogaster",
+     "thresh": 0.05}
+
+returns the reformatted table (see Ontologizer.reformat_table) along with
+latency and queue-depth metrics.  GET /metrics returns service-wide counters.
+"""
+import os
+import stat
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import SocketServer
+import BaseHTTPServer
+import simplejson
+import files
+import helpers
+from ontologize import Ontologizer
+
+
+logger = helpers.get_logger()
+
+
+class BadRequest(Exception):
+    """
+    Raised for malformed enrichment requests, before they are queued.
+    """
+    pass
+
+
+def _gene_ids(genes, field):
+    """
+    Check that `genes` is a non-empty list of gene IDs and return them as
+    ASCII strings, raising BadRequest otherwise.
+    """
+    if not isinstance(genes, list) or not genes:
+        raise BadRequest('%s must be a non-empty list of strings' % field)
+    ids = []
+    for gene in genes:
+        if not isinstance(gene, basestring):
+            raise BadRequest('%s must be a non-empty list of strings' % field)
+        try:
+            gene = gene.encode('ascii')
+        except UnicodeError:
+            raise BadRequest('%s contains a non-ASCII ID: %r' % (field, gene))
+        if not gene or len(gene.split()) != 1 or gene.strip() != gene:
+            raise BadRequest('%s contains an empty ID or an ID with '
+                             'whitespace: %r' % (field, gene))
+        ids.append(gene)
+    return ids
+
+
+class _Job(object):
+    """
+    A single enrichment request waiting on its batch.
+    """
+    def __init__(self, genes, thresh=None):
+        self.genes = genes
+        self.thresh = thresh
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.batch_size = None
+        self.queue_depth = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    @property
+    def metrics(self):
+        return {
+            'batch_size': self.batch_size,
+            'queue_depth': self.queue_depth,
+            'queued_seconds': self.started - self.submitted,
+            'run_seconds': self.finished - self.started,
+            'total_seconds': self.finished - self.submitted,
+        }
+
+
+class _Batch(object):
+    """
+    Jobs sharing an organism and population, to be run in one pass.
+    """
+    def __init__(self, organism, population):
+        self.organism = organism
+        self.population = population
+        self.jobs = []
+        self.timer = None
+
+
+class EnrichmentService(object):
+    def __init__(self, organisms=None, associations=None,
+                 lookup_file=files.FILES['lookup'],
+                 path=files.FILES['ontologizer'], go=files.FILES['go'],
+                 calculation='Parent-Child-Union', dot=0.05,
+                 mtc='Westfall-Young-Single-Step', resampling_steps=100,
+                 window=0.05, max_batch=32, max_running=1, timeout=3600,
+                 workdir=None, keep=False):
+        """
+        organisms:
+            List of organisms to serve, using the association files in
+            files.FILES['association']; defaults to all organisms in
+            files.GENOME_ASSOCIATIONS.  The first one is used when a request
+            does not specify an organism.
+
+        associations:
+            Instead of `organisms`, a dictionary of organism name to GO
+            association file.  Since dictionaries are unordered, requests
+            must then always specify an organism unless there is only one.
+
+        lookup_file:
+            Path to the GO lookup JSON file, loaded once at startup.
+
+        path, go, calculation, dot, mtc, resampling_steps:
+            Passed to every Ontologizer run; see Ontologizer.
+
+        window:
+            Seconds to wait after the first request of a batch for other
+            requests sharing its population.
+
+        max_batch:
+            Run a batch immediately once it has this many requests.
+
+        max_running:
+            Maximum number of concurrent Ontologizer runs.
+
+        timeout:
+            Seconds a request waits for its batch before giving up; None to
+            wait forever.
+
+        workdir:
+            Directory in which per-batch output directories are created;
+            defaults to a new temp dir that is removed by close().
+
+        keep:
+            If True, do not delete per-batch output directories or the
+            default workdir.
+
+        The jar, .obo file and association files must already exist (see
+        download_ontologization_files.py); ValueError is raised otherwise.
+        """
+        if organisms and associations:
+            raise ValueError("please provide either `organisms` or "
+                             "`associations`, not both")
+        if associations is not None:
+            self.associations = dict(associations)
+            if len(self.associations) == 1:
+                self.default_organism = self.associations.keys()[0]
+            else:
+                self.default_organism = None
+        else:
+            if organisms is None:
+                organisms = sorted(files.GENOME_ASSOCIATIONS.keys())
+            self.associations = {}
+            for organism in organisms:
+                try:
+                    self.associations[organism] = \
+                        files.FILES['association'][organism]
+                except KeyError:
+                    raise ValueError('organism not supported: %s' % organism)
+            self.default_organism = organisms[0]
+
+        required = [path, go] + sorted(self.associations.values())
+        for fn in required:
+            if not os.path.exists(fn):
+                raise ValueError('%s does not exist; see '
+                                 'download_ontologization_files.py' % fn)
+
+        logger.info('Loading GO lookup from %s' % lookup_file)
+        self.lookup = simplejson.load(open(lookup_file))
+
+        self.path = path
+        self.go = go
+        self.calculation = calculation
+        self.dot = dot
+        self.mtc = mtc
+        self.resampling_steps = resampling_steps
+        self.window = window
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self.keep = keep
+        self._own_workdir = workdir is None
+        self.workdir = workdir or tempfile.mkdtemp(prefix='ontologization-')
+        if not os.path.exists(self.workdir):
+            os.makedirs(self.workdir)
+
+        self._lock = threading.Lock()
+        self._running = threading.BoundedSemaphore(max_running)
+        self._pending = {}
+        self._queue_depth = 0
+        self._n_requests = 0
+        self._n_batches = 0
+
+    def enrich(self, genes, population, organism=None, thresh=None):
+        """
+        Run enrichment for `genes` against `population`, blocking until the
+        batch containing this request has finished.  Returns a dictionary
+        with keys "header", "results" and "metrics".
+
+        Raises BadRequest if the arguments are malformed.
+        """
+        genes = _gene_ids(genes, 'genes')
+        population = sorted(set(_gene_ids(population, 'population')))
+        if organism is None:
+            organism = self.default_organism
+            if organism is None:
+                raise BadRequest('organism must be specified')
+        if not isinstance(organism, basestring):
+            raise BadRequest('organism must be a string or null')
+        if organism not in self.associations:
+            raise BadRequest('organism not served: %s' % organism)
+        if thresh is not None and (
+                isinstance(thresh, bool)
+                or not isinstance(thresh, (int, long, float))):
+            raise BadRequest('thresh must be a number or null')
+
+        key = (organism, hashlib.md5('\n'.join(population)).hexdigest())
+        job = _Job(genes, thresh=thresh)
+
+        with self._lock:
+            self._n_requests += 1
+            self._queue_depth += 1
+            job.queue_depth = self._queue_depth
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = _Batch(organism, population)
+                self._pending[key] = batch
+                batch.timer = threading.Timer(
+                    self.window, self._flush, [key, batch])
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.jobs.append(job)
+            full = len(batch.jobs) >= self.max_batch
+            if full:
+                self._take(key)
+        if full:
+            batch.timer.cancel()
+            self._run(batch)
+
+        if not job.done.wait(self.timeout):
+            raise RuntimeError('timed out after %ss waiting for batch'
+                               % self.timeout)
+        if job.error is not None:
+            raise job.error
+        result = dict(job.result)
+        result['metrics'] = job.metrics
+        return result
+
+    @property
+    def metrics(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue_depth,
+                'pending_batches': len(self._pending),
+                'requests': self._n_requests,
+                'batches': self._n_batches,
+            }
+
+    def close(self):
+        """
+        Remove the default workdir, unless `keep` was set.
+        """
+        if self._own_workdir and not self.keep:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _take(self, key):
+        """
+        Remove the pending batch for `key` so no more jobs join it.  Must be
+        called with self._lock held.
+        """
+        del self._pending[key]
+        self._n_batches += 1
+
+    def _flush(self, key, batch):
+        """
+        Called by the batch's timer; runs `batch` unless it was already
+        taken because it filled up.
+        """
+        with self._lock:
+            if self._pending.get(key) is not batch:
+                return
+            self._take(key)
+        self._run(batch)
+
+    def _run(self, batch):
+        self._running.acquire()
+        try:
+            self._run_batch(batch)
+        finally:
+            self._running.release()
+
+    def _run_batch(self, batch):
+        outdir = None
+        try:
+            started = time.time()
+            with self._lock:
+                self._queue_depth -= len(batch.jobs)
+            for job in batch.jobs:
+                job.started = started
+                job.batch_size = len(batch.jobs)
+
+            outdir = tempfile.mkdtemp(dir=self.workdir, prefix='batch-')
+            studydir = os.path.join(outdir, 'study')
+            os.makedirs(studydir)
+            studies = []
+            for i, job in enumerate(batch.jobs):
+                study = os.path.join(studydir, 'study-%s.txt' % i)
+                fout = open(study, 'w')
+                fout.write('\n'.join(job.genes) + '\n')
+                fout.close()
+                studies.append(study)
+
+            population = os.path.join(outdir, 'population.txt')
+            fout = open(population, 'w')
+            fout.write('\n'.join(batch.population) + '\n')
+            fout.close()
+
+            self._ontologizer(
+                studydir, population, batch.organism, outdir).ontologize()
+
+            for job, study in zip(batch.jobs, studies):
+                try:
+                    job.result = self._reformatted(
+                        self._ontologizer(
+                            study, population, batch.organism, outdir),
+                        job.thresh)
+                except Exception as e:
+                    job.error = e
+        except Exception as e:
+            logger.info('ERROR running batch: %s' % e)
+            for job in batch.jobs:
+                if job.result is None:
+                    job.error = e
+        finally:
+            if outdir is not None and not self.keep:
+                shutil.rmtree(outdir, ignore_errors=True)
+            finished = time.time()
+            for job in batch.jobs:
+                if job.started is None:
+                    job.started = finished
+                job.finished = finished
+                job.done.set()
+
+    def _ontologizer(self, genes, population, organism, outdir):
+        return Ontologizer(
+            genes=genes, population=population, path=self.path,
+            association=self.associations[organism], go=self.go,
+            calculation=self.calculation, dot=self.dot, mtc=self.mtc,
+            resampling_steps=self.resampling_steps, outdir=outdir)
+
+    def _reformatted(self, o, thresh):
+        if not os.path.exists(o._tablefile):
+            raise IOError('Ontologizer did not create %s; see %s'
+                          % (o._tablefile,
+                             os.path.join(o.outdir, '.ontologizer.log')))
+        o.reformat_table(thresh=thresh, lookup=self.lookup)
+        f = open(o._reformatted_tablefile)
+        header = f.readline().rstrip('\n\r').split('\t')
+        results = [line.rstrip('\n\r').split('\t') for line in f]
+        f.close()
+        return {'header': header, 'results': results}
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._respond(200, self.server.service.metrics)
+        else:
+            self._respond(404, {'error': 'not found: %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/enrich':
+            self._respond(404, {'error': 'not found: %s' % self.path})
+            return
+        try:
+            request = self._request()
+            result = self.server.service.enrich(
+                genes=request['genes'],
+                population=request['population'],
+                organism=request.get('organism'),
+                thresh=request.get('thresh'))
+        except BadRequest as e:
+            self._respond(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._respond(500, {'error': str(e)})
+            return
+        self._respond(200, result)
+
+    def _request(self):
+        """
+        Parse the JSON request body, raising BadRequest if it is not an
+        object with "genes" and "population" fields.
+        """
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = simplejson.loads(self.rfile.read(length))
+        except ValueError as e:
+            raise BadRequest('invalid JSON: %s' % e)
+        if not isinstance(request, dict):
+            raise BadRequest('request must be a JSON object')
+        for field in ['genes', 'population']:
+            if field not in request:
+                raise BadRequest('missing field: %s' % field)
+        return request
+
+    def _respond(self, code, data):
+        body = simplejson.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # client_address is empty for Unix sockets, so don't use the default
+        # BaseHTTPRequestHandler.address_string()
+        logger.info(format % args)
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def make_server(service, host='127.0.0.1', port=8765, socket_path=None):
+    """
+    Return a server for `service`, listening on `socket_path` if provided,
+    otherwise on `host`:`port`.  Call serve_forever() on the result to run it,
+    and server_close() to stop listening (which also removes the socket).
+
+    A stale socket at `socket_path` is replaced; any other existing file
+    raises ValueError.
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise ValueError('%s exists and is not a socket'
+                                 % socket_path)
+            os.unlink(socket_path)
+        server = _UnixServer(socket_path, _Handler)
+    else:
+        server = _TCPServer((host, port), _Handler)
+    server.service = service
+    return server
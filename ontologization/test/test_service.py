@@ -0,0 +1,354 @@
+"""
+Tests for ontologization.service.
+
+These run entirely on localhost.  Ontologizer.jar is replaced by a fake `java`
+on PATH that writes table and annotation files for each study set, so no JVM
+or downloaded data files are needed.
+"""
+import os
+import sys
+import stat
+import socket
+import shutil
+import httplib
+import tempfile
+import threading
+import unittest
+import simplejson
+from ontologization import service
+
+
+FAKE_JAVA = """#!%(python)s
+# Stands in for `java -jar Ontologizer.jar`; see test_service.py
+import os
+import sys
+args = sys.argv[1:]
+opt = lambda name: args[args.index(name) + 1]
+studydir = opt('-s')
+outdir = opt('--outdir')
+open(os.environ['FAKE_JAVA_LOG'], 'a').write(studydir + '\\n')
+for fn in sorted(os.listdir(studydir)):
+    genes = open(os.path.join(studydir, fn)).read().split()
+    if 'NOTABLE' in genes:
+        continue
+    name = '-'.join([os.path.splitext(fn)[0], opt('-c'), opt('-m')])
+    p_col = 'p.adjusted'
+    if 'BADTABLE' in genes:
+        p_col = 'p.other'
+    table = open(os.path.join(outdir, 'table-' + name + '.txt'), 'w')
+    table.write('ID\\tp\\t' + p_col + '\\n')
+    table.write('GO:0000001\\t0.001\\t0.01\\n')
+    table.write('GO:0000002\\t0.1\\t0.2\\n')
+    table.close()
+    anno = open(os.path.join(outdir, 'anno-' + name + '.txt'), 'w')
+    for gene in genes:
+        anno.write(gene + '\\t-\\tdirect={GO:0000001,GO:0000002}\\n')
+    anno.close()
+"""
+
+LOOKUP = {
+    'GO:0000001': {'name': ['first term'], 'def': ['first definition']},
+    'GO:0000002': {'name': ['second term'], 'def': ['second definition']},
+}
+
+POPULATION = ['g1', 'g2', 'g3', 'g4']
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class ServiceTest(unittest.TestCase):
+    window = 0.2
+    max_batch = 32
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        bindir = os.path.join(self.tmp, 'bin')
+        os.makedirs(bindir)
+        java = os.path.join(bindir, 'java')
+        fout = open(java, 'w')
+        fout.write(FAKE_JAVA % dict(python=sys.executable))
+        fout.close()
+        os.chmod(java, os.stat(java).st_mode | stat.S_IEXEC)
+
+        self.java_log = os.path.join(self.tmp, 'java.log')
+        open(self.java_log, 'w').close()
+        self._environ = dict(os.environ)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_JAVA_LOG'] = self.java_log
+
+        self.lookup_file = self._touch('go_lookup.json')
+        simplejson.dump(LOOKUP, open(self.lookup_file, 'w'))
+        self.workdir = os.path.join(self.tmp, 'work')
+        self.service = self._service()
+        self.server = service.make_server(self.service, port=0)
+        self._serve(self.server)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.tmp)
+
+    def _touch(self, fn):
+        fn = os.path.join(self.tmp, fn)
+        open(fn, 'w').close()
+        return fn
+
+    def _service(self, **kwargs):
+        kw = dict(
+            associations={
+                'dmelanogaster': self._touch('fly.gz'),
+                'mmusculus': self._touch('mouse.gz')},
+            lookup_file=self.lookup_file,
+            path=self._touch('Ontologizer.jar'),
+            go=self._touch('go.obo'),
+            window=self.window,
+            max_batch=self.max_batch,
+            timeout=30,
+            workdir=self.workdir)
+        kw.update(kwargs)
+        return service.EnrichmentService(**kw)
+
+    def _serve(self, server):
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def _connection(self):
+        return httplib.HTTPConnection('127.0.0.1',
+                                      self.server.server_address[1])
+
+    def request(self, method, path, body=None, conn=None):
+        conn = conn or self._connection()
+        if body is not None and not isinstance(body, basestring):
+            body = simplejson.dumps(body)
+        conn.request(method, path, body)
+        response = conn.getresponse()
+        result = response.status, simplejson.loads(response.read())
+        conn.close()
+        return result
+
+    def body(self, genes, population=POPULATION, **kwargs):
+        body = dict(genes=genes, population=population,
+                    organism='dmelanogaster')
+        body.update(kwargs)
+        return body
+
+    def enrich(self, genes, **kwargs):
+        return self.request('POST', '/enrich', self.body(genes, **kwargs))
+
+    def concurrently(self, bodies):
+        results = [None] * len(bodies)
+
+        def run(i, body):
+            results[i] = self.request('POST', '/enrich', body)
+
+        threads = [threading.Thread(target=run, args=(i, body))
+                   for i, body in enumerate(bodies)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def java_calls(self):
+        return len(open(self.java_log).read().splitlines())
+
+
+class TestEnrich(ServiceTest):
+    def test_single_request(self):
+        code, result = self.enrich(['g1', 'g2'])
+        self.assertEqual(code, 200)
+        self.assertEqual(result['header'][:3],
+                         ['name', 'definition', 'direct'])
+        self.assertEqual(len(result['results']), 2)
+        first = result['results'][0]
+        self.assertEqual(first[:2], ['first term', 'first definition'])
+        self.assertEqual(sorted(first[2].split(',')), ['g1', 'g2'])
+        metrics = result['metrics']
+        self.assertEqual(metrics['batch_size'], 1)
+        self.assertEqual(metrics['queue_depth'], 1)
+        for key in ['queued_seconds', 'run_seconds', 'total_seconds']:
+            self.assertTrue(metrics[key] >= 0)
+
+    def test_same_population_coalesces(self):
+        bodies = [self.body(['g%s' % i]) for i in range(1, 5)]
+        bodies.append(self.body(['g1'], population=POPULATION[::-1]))
+        results = self.concurrently(bodies)
+        for code, result in results:
+            self.assertEqual(code, 200)
+            self.assertEqual(result['metrics']['batch_size'], 5)
+        self.assertEqual(results[0][1]['results'][0][2], 'g1')
+        self.assertEqual(results[1][1]['results'][0][2], 'g2')
+        code, metrics = self.request('GET', '/metrics')
+        self.assertEqual(code, 200)
+        self.assertEqual(metrics['batches'], 1)
+        self.assertEqual(metrics['requests'], 5)
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['pending_batches'], 0)
+        self.assertEqual(self.java_calls(), 1)
+
+    def test_different_population_or_organism_separate(self):
+        results = self.concurrently([
+            self.body(['g1']),
+            self.body(['g1'], population=POPULATION + ['g5']),
+            self.body(['g1'], organism='mmusculus'),
+            self.body(['g2']),
+        ])
+        sizes = [result['metrics']['batch_size'] for code, result in results]
+        self.assertEqual(sizes, [2, 1, 1, 2])
+        code, metrics = self.request('GET', '/metrics')
+        self.assertEqual(metrics['batches'], 3)
+        self.assertEqual(self.java_calls(), 3)
+
+    def test_thresh_per_job(self):
+        results = self.concurrently([
+            self.body(['g1'], population=POPULATION, thresh=0.05),
+            self.body(['g2']),
+        ])
+        self.assertEqual(results[0][1]['metrics']['batch_size'], 2)
+        self.assertEqual(len(results[0][1]['results']), 1)
+        self.assertEqual(len(results[1][1]['results']), 2)
+
+    def test_bad_requests(self):
+        bad = [
+            '{not json',
+            '[1]',
+            {'genes': ['g1']},
+            {'population': POPULATION},
+            self.body('abc'),
+            self.body(['g1'], population='xyz'),
+            self.body([]),
+            self.body([1]),
+            self.body(['g 1']),
+            self.body([u'g\xe9']),
+            self.body(['g1'], population=['g1', u'g\xe9']),
+            self.body(['g1'], thresh='0.1'),
+            self.body(['g1'], thresh=True),
+            self.body(['g1'], organism=1),
+            self.body(['g1'], organism='yeast'),
+        ]
+        for body in bad:
+            code, result = self.request('POST', '/enrich', body)
+            self.assertEqual(code, 400, (body, result))
+            self.assertTrue(result['error'])
+        self.assertEqual(self.request('GET', '/metrics')[1]['requests'], 0)
+        self.assertEqual(self.java_calls(), 0)
+
+    def test_not_found(self):
+        self.assertEqual(self.request('GET', '/enrich')[0], 404)
+        self.assertEqual(self.request('POST', '/metrics', '{}')[0], 404)
+
+    def test_missing_table(self):
+        results = self.concurrently([
+            self.body(['NOTABLE']),
+            self.body(['g1']),
+        ])
+        self.assertEqual(results[0][0], 500)
+        self.assertTrue('did not create' in results[0][1]['error'])
+        self.assertEqual(results[1][0], 200)
+
+    def test_server_side_value_error(self):
+        # ValueError raised while reformatting the table is a server error,
+        # not a bad request
+        code, result = self.enrich(['BADTABLE'])
+        self.assertEqual(code, 500)
+
+    def test_batch_setup_failure(self):
+        shutil.rmtree(self.workdir)
+        code, result = self.enrich(['g1'])
+        self.assertEqual(code, 500)
+
+
+class TestMaxBatch(ServiceTest):
+    window = 30
+    max_batch = 2
+
+    def test_max_batch_flushes_early(self):
+        bodies = [self.body(['g1'])] * 4
+        results = self.concurrently(bodies)
+        for code, result in results:
+            self.assertEqual(code, 200)
+            self.assertEqual(result['metrics']['batch_size'], 2)
+            self.assertTrue(result['metrics']['total_seconds'] < self.window)
+        code, metrics = self.request('GET', '/metrics')
+        self.assertEqual(metrics['batches'], 2)
+        self.assertEqual(metrics['pending_batches'], 0)
+        self.assertEqual(self.java_calls(), 2)
+
+
+class TestUnixSocket(ServiceTest):
+    def test_unix_socket(self):
+        path = os.path.join(self.tmp, 'service.sock')
+        server = service.make_server(self.service, socket_path=path)
+        self._serve(server)
+        try:
+            code, result = self.request(
+                'POST', '/enrich',
+                self.body(['g1']),
+                conn=UnixHTTPConnection(path))
+            self.assertEqual(code, 200)
+            self.assertEqual(result['metrics']['batch_size'], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_stale_socket_replaced(self):
+        path = os.path.join(self.tmp, 'service.sock')
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(path)
+        s.close()
+        server = service.make_server(self.service, socket_path=path)
+        server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_refuses_to_replace_regular_file(self):
+        path = self._touch('not-a-socket')
+        self.assertRaises(ValueError, service.make_server, self.service,
+                          socket_path=path)
+        self.assertTrue(os.path.exists(path))
+
+
+class TestService(ServiceTest):
+    def test_missing_files(self):
+        for kw in ['path', 'go']:
+            self.assertRaises(
+                ValueError, self._service,
+                **{kw: os.path.join(self.tmp, 'missing')})
+        self.assertRaises(
+            ValueError, self._service,
+            associations={'dmelanogaster': os.path.join(self.tmp, 'missing')})
+
+    def test_organisms_or_associations(self):
+        self.assertRaises(ValueError, self._service,
+                          organisms=['dmelanogaster'])
+
+    def test_default_organism(self):
+        s = self._service(associations={'dmelanogaster': self._touch('a')})
+        self.assertEqual(s.default_organism, 'dmelanogaster')
+        self.assertRaises(service.BadRequest, self.service.enrich,
+                          ['g1'], POPULATION)
+
+    def test_close_removes_default_workdir(self):
+        s = self._service(workdir=None)
+        self.assertTrue(os.path.exists(s.workdir))
+        s.close()
+        self.assertFalse(os.path.exists(s.workdir))
+
+    def test_close_keeps_given_workdir(self):
+        self.service.close()
+        self.assertTrue(os.path.exists(self.workdir))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,6 +19,7 @@ setup(
         packages=['ontologization',
                   'ontologization.data',
                   'ontologization.scripts',
+                  'ontologization.test',
                   ],
         author="Ryan Dale",
         description=long_description,
@@ -26,7 +27,8 @@ setup(
         url="none",
         package_data = {'ontologization':["data/*"]},
         package_dir = {"ontologization": "ontologization"},
-        scripts = ['ontologization/scripts/download_ontologization_files.py'],
+        scripts = ['ontologization/scripts/download_ontologization_files.py',
+                   'ontologization/scripts/ontologization_service.py'],
         author_email="dalerr@niddk.nih.gov",
         classifiers=['Development Status :: 4 - Beta'],
     )
@@ -1 +1,2 @@
 python -m doctest README.rst
+python -m unittest discover -s ontologization/test -t .